@@ -4,14 +4,60 @@ from tensorflow import keras
 import tensorflow_probability as tfp
 
 
+class MaskConstraint(keras.constraints.Constraint):
+    """
+    Kernel constraint zeroing all masked entries of a MADE kernel after each optimizer step.
+
+    This keeps the stored kernels masked, so no mask multiplication is needed on the forward pass.
+    """
+    
+    def __init__(self, mask):
+        self.mask = mask
+    
+    def __call__(self, w):
+        return w * tf.cast(self.mask, w.dtype)
+
+
+class MaskedInitializer(keras.initializers.Initializer):
+    """
+    Glorot uniform initializer with the masked entries of a MADE kernel set to zero.
+    """
+    
+    def __init__(self, mask):
+        self.mask = mask
+        self.initializer = keras.initializers.GlorotUniform()
+    
+    def __call__(self, shape, dtype=None, **kwargs):
+        w = self.initializer(shape, dtype=dtype)
+        return w * tf.cast(self.mask, w.dtype)
+
+
+def masked_gradient(kernel, mask):
+    """
+    Identity on a MADE kernel whose gradient is masked, so masked entries get zero gradients as if the mask was multiplied in.
+    """
+    @tf.custom_gradient
+    def identity(k):
+        def grad(dy):
+            return dy * tf.cast(mask, dy.dtype)
+        return tf.identity(k), grad
+    return identity(kernel)
+
+
 class MADE(tf.layers.Layer):
     """
     A class representing the MADE architecture (Masked Autoencoders for Distribution Estimation, see arXiv:1502.03509).
 
     Inherits from tensorflow.layers.Layer and can be treated as such.
+
+    The masks are stored in the kernels themselves: they are applied by the kernel initializer and by a kernel constraint 
+    after each optimizer step. MADE.set_weights as well as set_weights and load_weights of MAFlowModel and MAConditionalFlowModel 
+    re-apply them. Any other direct write to the kernels (e.g. set_weights of an enclosing model or variable.assign in a 
+    custom training loop) must be followed by apply_masks(), else the layer is no longer autoregressive.
     """
     
-    def __init__(self, in_shape, num_layers=1, num_nodes=128, activation="relu", random_nums=[], n_params=0, silent=False):
+    def __init__(self, in_shape, num_layers=1, num_nodes=128, activation="relu", random_nums=[], n_params=0, silent=False, 
+                 mixed_precision=False, out_multiplier=1, order=None):
         """
         Parameters
         ----------
@@ -21,8 +67,9 @@ class MADE(tf.layers.Layer):
             number of hidden layers (default 1)
         num_nodes: int
             number of nodes per hidden layer (default 128)
-        activation: string
+        activation: string or list
             type of activation function (supports 'tanh', 'sigmoid', 'linear' and 'relu', default 'relu')
+            or a list with one activation function for each of the out_multiplier output heads
         random_nums: array-like
             random numbers assigned to each hidden node to determine its connection to previous nodes (see original paper, default [])
             if [] random numbers are generated by the class, else shape must be (num_layers, num_nodes) and must be convertible to a np array
@@ -30,9 +77,17 @@ class MADE(tf.layers.Layer):
             number of conditional parameters (i.e. additional inputs that every node may depend on, default 0)
         silent: boolean
             whether the network prints info messages outside of tensorflow (default False)
+        mixed_precision: boolean
+            whether to run the matmuls in bfloat16 while keeping float32 weights and outputs (default False)
+        out_multiplier: int
+            number of output heads sharing the hidden layers, if larger than 1 the layer returns a list of out_multiplier 
+            outputs with in_shape entries each (default 1)
+        order: array-like or None
+            autoregressive order of the inputs (excluding conditional parameters), i.e. a permutation of 1, ..., in_shape giving 
+            the position of each input, None for the natural order (default None)
         """
         
-        super().__init__()
+        super().__init__(dtype="mixed_bfloat16" if mixed_precision else None)
         self.in_shape = in_shape
         if in_shape < 2:
             raise Exception("MADE Layer only supports at least two inputs.")
@@ -47,9 +102,18 @@ class MADE(tf.layers.Layer):
                   ", "+str(num_nodes)+", but has shape "+str(self.nums.shape)+". Using internal rng instead.")
             self.nums = []
         self.activation = activation
-        if activation not in ["relu", "tanh", "sigmoid", "linear"]:
-            raise Exception("Activation function must be 'linear', 'relu', 'tanh' or 'sigmoid'.")
+        self.out_multiplier = out_multiplier
+        self.activations = activation if isinstance(activation, list) else out_multiplier * [activation]
+        if len(self.activations) != out_multiplier:
+            raise Exception("Either give one activation function or one for each output head!")
+        for a in self.activations:
+            if a not in ["relu", "tanh", "sigmoid", "linear"]:
+                raise Exception("Activation function must be 'linear', 'relu', 'tanh' or 'sigmoid'.")
+        # Resolve the activation functions once instead of on every call
+        activation_fns = {"relu": tf.nn.relu, "tanh": tf.tanh, "sigmoid": tf.sigmoid, "linear": tf.identity}
+        self._activation_fns = [activation_fns[a] for a in self.activations]
         self.n_params = n_params
+        self.order = np.arange(1, in_shape+1) if order is None else np.array(order)
         if n_params != 0 and not silent:
             print("Info: if you use conditional MADE layers, the conditional parameter(s) must be given as the first input(s) in "+
                   "the input vector.")
@@ -68,11 +132,24 @@ class MADE(tf.layers.Layer):
         x = 1 if self.n_params > 0 else 0
         self.nums = np.concatenate([np.zeros((self.num_layers, x)), self.nums], axis=1)
         self.nums += self.n_params
+        # Degrees of the input and output nodes used to build the masks
+        d_in = np.concatenate([np.arange(1, self.n_params+1), self.order+self.n_params])
+        d_out = self.order + self.n_params
+        
+        # Masks are fixed by the node degrees, so they are built first (as uint8) and enforced on the kernels by a constraint
+        self.masks.append(tf.constant((self.nums[0][:,None] >= d_in[None,:]).astype(np.uint8).T))
+        for l in range(1, self.num_layers):
+            self.masks.append(tf.constant((self.nums[l][:,None] >= self.nums[l-1][None,:]).astype(np.uint8).T))
+        # Output d depends on hidden node k iff nums[k] < d, giving shape (num_nodes+x, in_shape)
+        # All output heads share the same connectivity
+        out_mask = (self.nums[self.num_layers-1][:,None] < d_out[None,:]).astype(np.uint8)
+        self.masks.append(tf.constant(np.tile(out_mask, (1, self.out_multiplier))))
         
         # Input to hidden layer
         self.kernels.append(self.add_weight(
             shape=(self.in_shape+self.n_params, self.num_nodes+x), 
-            initializer="glorot_uniform", 
+            initializer=MaskedInitializer(self.masks[0]), 
+            constraint=MaskConstraint(self.masks[0]),
             trainable=True, 
             name="input_kernel"
         ))
@@ -82,16 +159,13 @@ class MADE(tf.layers.Layer):
             trainable=True,
             name="input_bias",
         ))
-        self.masks.append(np.array(
-            [[(1 if self.nums[0,k] >= d else 0) for d in range(1, self.in_shape+1+self.n_params)] 
-             for k in range(0, self.num_nodes+x)], dtype=np.float32
-        ).T)
         
         # hidden layer to hidden layer
         for l in range(1, self.num_layers):
             self.kernels.append(self.add_weight(
                 shape=(self.num_nodes+x, self.num_nodes+x),
-                initializer="glorot_uniform", 
+                initializer=MaskedInitializer(self.masks[l]), 
+                constraint=MaskConstraint(self.masks[l]),
                 trainable=True, 
                 name="hidden_kernel_"+str(l)
             ))
@@ -101,51 +175,57 @@ class MADE(tf.layers.Layer):
                 trainable=True,
                 name="input_bias",
             ))
-            self.masks.append(np.array(
-                [[(1 if self.nums[l,k] >= self.nums[l-1,j] else 0) for j in range(0, self.num_nodes+x)] 
-                 for k in range(0, self.num_nodes+x)], dtype=np.float32
-            ).T)
         
         # Hidden layer to output layer
         self.kernels.append(self.add_weight(
-            shape=(self.num_nodes+x, self.in_shape), 
-            initializer="glorot_uniform", 
+            shape=(self.num_nodes+x, self.in_shape*self.out_multiplier), 
+            initializer=MaskedInitializer(self.masks[self.num_layers]), 
+            constraint=MaskConstraint(self.masks[self.num_layers]),
             trainable=True, 
             name="output_kernel"
         ))
         self.biases.append(self.add_weight(
-            shape=(self.in_shape,),
+            shape=(self.in_shape*self.out_multiplier,),
             initializer="zeros",
             trainable=True,
             name="output_bias",
         ))
-        self.masks.append(np.array(
-            [[(1 if self.nums[self.num_layers-1,k] < d+self.n_params else 0) for k in range(0, self.num_nodes+x)] 
-             for d in range(1, self.in_shape+1)],
-            dtype=np.float32
-        ).T)
+    
+    def apply_masks(self):
+        """
+        Zero the masked entries of all kernels. Needed after writing to the kernels other than through an optimizer step.
+        """
+        for kernel, mask in zip(self.kernels, self.masks):
+            # Write zeros without reading the kernel, as reads may be autocast to bfloat16 with mixed_precision
+            indices = tf.where(tf.equal(mask, 0))
+            kernel.scatter_nd_update(indices, tf.zeros(tf.shape(indices)[0], dtype=kernel.dtype))
+    
+    def set_weights(self, weights):
+        super().set_weights(weights)
+        self.apply_masks()
     
     def call(self, x, training=True):
         #Use relu for hidden layer and activation parameter for output
+        x = tf.cast(x, self.compute_dtype)
         for i in range(self.num_layers):
-            x = tf.maximum(tf.matmul(x, tf.multiply(self.masks[i], self.kernels[i])) + self.biases[i], 0)
-        x = tf.matmul(x, tf.multiply(self.masks[self.num_layers], self.kernels[self.num_layers])) + self.biases[self.num_layers]
-        if self.activation == "relu":
-            x = tf.maximum(x, 0)
-        elif self.activation == "tanh":
-            x = tf.tanh(x)
-        elif self.activation == "sigmoid":
-            x = tf.sigmoid(x)
-        return x
+            kernel = masked_gradient(tf.cast(self.kernels[i], x.dtype), self.masks[i])
+            x = tf.maximum(tf.matmul(x, kernel) + tf.cast(self.biases[i], x.dtype), 0)
+        kernel = masked_gradient(tf.cast(self.kernels[self.num_layers], x.dtype), self.masks[self.num_layers])
+        x = tf.matmul(x, kernel) + tf.cast(self.biases[self.num_layers], x.dtype)
+        # The flow transformations and log_det are always computed in float32
+        if self.out_multiplier == 1:
+            return tf.cast(self._activation_fns[0](x), tf.float32)
+        heads = tf.split(x, self.out_multiplier, axis=-1)
+        return [tf.cast(fn(head), tf.float32) for fn, head in zip(self._activation_fns, heads)]
 
 
 # Simple Model ------------------------
 
-def MACoupling(in_shape, n_models=2, activations=[], num_layers=1, num_nodes=128):
+def MACoupling(in_shape, n_models=2, activations=[], num_layers=1, num_nodes=128, mixed_precision=False, order=None):
     """
-    Convenience function to generate a stack of MADE layers for a masked autoregressive normalizing flow.
+    Convenience function to generate a MADE layer with several outputs for a masked autoregressive normalizing flow.
 
-    All MADE layers take the same inputs and produce different outputs.
+    All outputs share the hidden layers of a single MADE layer and only differ in their output layer.
     This is useful as most transformations used for Masked Autoregressive Normalizing Flows have more than one parameter.
 
     Parameters
@@ -153,14 +233,18 @@ def MACoupling(in_shape, n_models=2, activations=[], num_layers=1, num_nodes=128
     in_shape: int
         number of inputs for the MADE layers
     n_models: int
-        number of MADE layers (i.e. the number of outputs of the coupling layer is in_shape*n_models, default 2)
+        number of MADE output heads (i.e. the number of outputs of the coupling layer is in_shape*n_models, default 2)
     activations: array-like
-        activation functions used for the MADE layers (either [], then all layers use relu, or a list of activation functions for each MADE layer, 
+        activation functions used for the MADE outputs (either [], then all outputs use relu, or a list of activation functions for each output, 
         supports 'tanh', 'sigmoid', 'linear' and 'relu', default [])
     num_layers: int
         number of hidden layers of the MADE layers (default 1)
     num_nodes: int
         number of nodes in each hidden layer of the MADE layers (default 128)
+    mixed_precision: boolean
+        whether the MADE layers compute in bfloat16 (default False)
+    order: array-like or None
+        autoregressive order of the inputs of the MADE layer, see MADE (default None)
     """
     
     if activations == []:
@@ -168,19 +252,10 @@ def MACoupling(in_shape, n_models=2, activations=[], num_layers=1, num_nodes=128
     if len(activations) != n_models:
         raise Exception("Either give no activations [] or one for each parameter!")
     
-    rng = np.random.default_rng()
-    if in_shape > 2:
-        random_nums = rng.integers(low=1, high=in_shape, size=(num_layers, num_nodes))
-    else:
-        random_nums = []
-    
     _input = tf.layers.Input(shape=in_shape)
     
-    models = []
-    for i in range(n_models):
-        m = MADE(in_shape, num_layers=num_layers, num_nodes=num_nodes, activation=activations[i], 
-                 random_nums=random_nums, silent=True)(_input)
-        models.append(m)
+    models = MADE(in_shape, num_layers=num_layers, num_nodes=num_nodes, activation=activations, silent=True, 
+                  mixed_precision=mixed_precision, out_multiplier=n_models, order=order)(_input)
     
     return keras.Model(inputs=_input, outputs=models)
 
@@ -194,7 +269,8 @@ class MAFlowModel(keras.Model):
     For conditional density estimation use MAConditionalFlowModel.
     """
     
-    def __init__(self, n_coupling, in_shape, num_hidden_layers=1, num_nodes=128, permutations=None):
+    def __init__(self, n_coupling, in_shape, num_hidden_layers=1, num_nodes=128, permutations=None, mixed_precision=False, 
+                 batch_size=None, jit_compile=False):
         """
         Parameters
         ----------
@@ -208,11 +284,23 @@ class MAFlowModel(keras.Model):
             number of nodes in the hidden layers of the used MADE layers (default 128)
         permutations: array-like
             permutations used in between coupling layers, either None (then they are generated by the model) or with shape (n_coupling-1, in_shape), default None
+        mixed_precision: boolean
+            whether the MADE layers compute in bfloat16, the flow itself and log_det stay in float32 (default False)
+        batch_size: int or None
+            if given, smaller training/validation batches are zero-padded to this size and the padding is masked in the loss, 
+            so the compiled model is not rebuilt for the last batch (should match the batch size used in fit, default None)
+        jit_compile: boolean
+            whether to XLA-compile the flow transformation, i.e. model(x), model.predict(z) and everything using them 
+            (needs a TensorFlow build with XLA support, default False)
         """
         
         super().__init__()
         self.n_coupling = n_coupling
         self.in_shape = in_shape
+        self._compile_batch = batch_size
+        if jit_compile:
+            # reduce_retracing traces once with a generic batch dimension instead of once per batch size
+            self.call = tf.function(self.call, jit_compile=True, reduce_retracing=True)
         # Latent distribution: multivariate standard gaussian
         loc = [0.0 for i in range(in_shape)]
         scale = [1.0 for i in range(in_shape)]
@@ -220,41 +308,77 @@ class MAFlowModel(keras.Model):
         self.loss_tracker = keras.metrics.Mean(name="loss")
         self.logprob_tracker = keras.metrics.Mean(name="logprob")
         self.logdet_tracker = keras.metrics.Mean(name="logdet")
-        self.layers_list = [MACoupling(in_shape, n_models=2, activations=["tanh", "linear"], num_layers=num_hidden_layers, 
-                                       num_nodes=num_nodes) for i in range(n_coupling)]
         self.permutations = permutations
-        if permutations == None:
+        if permutations is None:
             self.permutations = []
             rng = np.random.default_rng()
             for i in range(self.n_coupling-1):
                 self.permutations.append(rng.permutation(in_shape))
+        # The permutations between coupling layers are folded into the autoregressive order of the MADE layers:
+        # x keeps its order through the flow and coupling layer i sees dimension orders[i][k] at position k+1.
+        # Only the total permutation is applied, once at the end of the forward pass (start of the inverse pass).
+        self.orders = [np.arange(in_shape)]
+        for p in self.permutations:
+            self.orders.append(self.orders[-1][p])
+        self.flow_permutation = tf.constant(self.orders[-1], dtype=tf.int32)
+        self.inv_flow_permutation = tf.constant(np.argsort(self.orders[-1]), dtype=tf.int32)
+        self.layers_list = [MACoupling(in_shape, n_models=2, activations=["tanh", "linear"], num_layers=num_hidden_layers, 
+                                       num_nodes=num_nodes, mixed_precision=mixed_precision, order=np.argsort(q)+1) 
+                            for q in self.orders]
+        # Row k of coupling layer i masks the dimension at position k+1 of its order in the inverse pass
+        self._eye_mask = tf.constant(np.stack([np.eye(self.in_shape, dtype=np.float32)[q] for q in self.orders]))
     
     @property
     def metrics(self):
         return [self.loss_tracker, self.logprob_tracker, self.logdet_tracker]
     
+    def apply_masks(self):
+        """
+        Zero the masked kernel entries of all MADE layers, see MADE.apply_masks.
+        """
+        for coupling in self.layers_list:
+            for layer in coupling.layers:
+                if isinstance(layer, MADE):
+                    layer.apply_masks()
+    
+    # Weights written directly (not by an optimizer step) bypass the kernel constraints, so re-apply the masks
+    def set_weights(self, weights):
+        super().set_weights(weights)
+        self.apply_masks()
+    
+    def load_weights(self, *args, **kwargs):
+        status = super().load_weights(*args, **kwargs)
+        self.apply_masks()
+        return status
+    
+    # Affine flow update and its log-determinant, fused into one kernel by XLA when the model uses jit_compile=True
+    def _affine(self, x, s, t):
+        return x * tf.exp(s) + t, tf.reduce_sum(s, axis=-1)
+    
     # training=True makes it so that model(x) gives latent space and model.predict(z) gives data space
     def call(self, x, training=True):
         direction = 1 if training else -1
         log_det = 0
+        # Undo the total permutation of the latent space on the backward pass
+        if not training and self.n_coupling > 1:
+            x = tf.gather(x, self.inv_flow_permutation, axis=-1)
         # Loop over coupling layers forwards if direction is 1, else backwards
         for i in range(self.n_coupling)[::direction]:
             if training:
                 s, t = self.layers_list[i](x)
-                x = x * tf.exp(s) + t
-                log_det += tf.reduce_sum(s, axis=-1)
+                x, det = self._affine(x, s, t)
+                log_det += det
             else:
-                for k in range(self.in_shape):
+                # Invert one dimension per iteration; a while_loop keeps a single loop body in the graph
+                def body(k, x):
                     s, t = self.layers_list[i](x)
-                    mask = np.array([(1 if j == k else 0) for j in range(self.in_shape)])
-                    inv_mask = 1 - mask
-                    x = x * inv_mask + (tf.exp(-s) * (x - t)) * mask
-            # Permutations between coupling layers
-            if (training and i != self.n_coupling-1) or (not training and i != 0):
-                j = i if training else i-1
-                # Perm on forward pass and inverse perm on backward pass
-                perm = self.permutations[j] if training else np.argsort(self.permutations[j])
-                x = tf.gather(x, perm, axis=-1)
+                    mask = self._eye_mask[i,k]
+                    inv_mask = 1.0 - mask
+                    return k+1, x * inv_mask + (tf.exp(-s) * (x - t)) * mask
+                _, x = tf.while_loop(lambda k, x: k < self.in_shape, body, [tf.constant(0), x])
+        # Apply the total permutation on the forward pass
+        if training and self.n_coupling > 1:
+            x = tf.gather(x, self.flow_permutation, axis=-1)
         return x, log_det
     
     def sample(self, n_points):
@@ -280,17 +404,39 @@ class MAFlowModel(keras.Model):
             the data space sample whose density should be inferred
         """
         z, log_det = self(x)
-        log_density = self.distribution.log_prob(z) + log_det
+        log_density = self._latent_log_prob(z) + log_det
         return tf.exp(log_density)
     
-    def log_loss(self, x):
+    # Log density of the standard gaussian latent distribution, written out instead of using self.distribution.log_prob
+    def _latent_log_prob(self, z):
+        return -0.5 * tf.reduce_sum(z * z, axis=-1) - 0.5 * self.in_shape * np.log(2 * np.pi)
+    
+    def log_loss(self, x, valid_mask=None):
         z, log_det = self(x)
-        log_likelihood = self.distribution.log_prob(z) + log_det
-        return -tf.reduce_mean(log_likelihood), -tf.reduce_mean(self.distribution.log_prob(z)), -tf.reduce_mean(log_det)
+        log_prob = self._latent_log_prob(z)
+        log_likelihood = log_prob + log_det
+        return (-self._masked_mean(log_likelihood, valid_mask), -self._masked_mean(log_prob, valid_mask), 
+                -self._masked_mean(log_det, valid_mask))
+    
+    # Mean over the valid (i.e. not padded) points of a batch
+    def _masked_mean(self, values, valid_mask):
+        if valid_mask is None:
+            return tf.reduce_mean(values)
+        values = tf.where(valid_mask, values, tf.zeros_like(values))
+        return tf.reduce_sum(values) / tf.reduce_sum(tf.cast(valid_mask, values.dtype))
+    
+    # Zero-pad a batch to the fixed batch size and return it with a mask marking the original points
+    def _pad_batch(self, data):
+        if self._compile_batch is None:
+            return data, None
+        n_points = tf.shape(data)[0]
+        data = tf.pad(data, [[0, tf.maximum(self._compile_batch-n_points, 0)], [0, 0]])
+        return data, tf.range(tf.shape(data)[0]) < n_points
     
     def train_step(self, data):
+        data, valid_mask = self._pad_batch(data)
         with tf.GradientTape() as tape:
-            loss, prob, det = self.log_loss(data)
+            loss, prob, det = self.log_loss(data, valid_mask)
         g = tape.gradient(loss, self.trainable_variables)
         self.optimizer.apply_gradients(zip(g, self.trainable_variables))
         self.loss_tracker.update_state(loss)
@@ -300,7 +446,8 @@ class MAFlowModel(keras.Model):
                 "logdet":self.logdet_tracker.result()}
     
     def test_step(self, data):
-        loss, prob, det = self.log_loss(data)
+        data, valid_mask = self._pad_batch(data)
+        loss, prob, det = self.log_loss(data, valid_mask)
         self.loss_tracker.update_state(loss)
         self.logprob_tracker.update_state(prob)
         self.logdet_tracker.update_state(det)
@@ -311,11 +458,12 @@ class MAFlowModel(keras.Model):
 # Conditional Model ---------------------
 
 
-def MAConditionalCoupling(in_shape, n_params, n_models=2, activations=[], num_layers=1, num_nodes=128):
+def MAConditionalCoupling(in_shape, n_params, n_models=2, activations=[], num_layers=1, num_nodes=128, mixed_precision=False, 
+                          order=None):
     """
-    Convenience function to generate a stack of MADE layers for a conditional masked autoregressive normalizing flow.
+    Convenience function to generate a MADE layer with several outputs for a conditional masked autoregressive normalizing flow.
 
-    All MADE layers take the same inputs and produce different outputs.
+    All outputs share the hidden layers of a single MADE layer and only differ in their output layer.
     This is useful as most transformations used for Masked Autoregressive Normalizing Flows have more than one parameter.
 
     Parameters
@@ -325,14 +473,18 @@ def MAConditionalCoupling(in_shape, n_params, n_models=2, activations=[], num_la
     n_params: int
         number of conditional parameters
     n_models: int
-        number of MADE layers (i.e. number of outputs of the coupling layer is in_shape*n_models, default 2)
+        number of MADE output heads (i.e. number of outputs of the coupling layer is in_shape*n_models, default 2)
     activations: array-like
-        activation functions used for the MADE layers (either [], then all layers use relu, or a list of activation functions for each MADE layer, 
+        activation functions used for the MADE outputs (either [], then all outputs use relu, or a list of activation functions for each output, 
         supports 'tanh', 'sigmoid', 'linear' and 'relu', default [])
     num_layers: int
         number of hidden layers of the MADE layers (default 1)
     num_nodes: int
         number of nodes in each hidden layer of the MADE layers (default 128)
+    mixed_precision: boolean
+        whether the MADE layers compute in bfloat16 (default False)
+    order: array-like or None
+        autoregressive order of the inputs of the MADE layer, see MADE (default None)
     """
     
     if activations == []:
@@ -340,19 +492,10 @@ def MAConditionalCoupling(in_shape, n_params, n_models=2, activations=[], num_la
     if len(activations) != n_models:
         raise Exception("Either give no activations [] or one for each parameter!")
     
-    rng = np.random.default_rng()
-    if in_shape > 2:
-        random_nums = rng.integers(low=1, high=in_shape, size=(num_layers, num_nodes))
-    else:
-        random_nums = []
-    
     _input = tf.layers.Input(shape=in_shape+n_params)
     
-    models = []
-    for i in range(n_models):
-        m = MADE(in_shape, num_layers=num_layers, num_nodes=num_nodes, activation=activations[i], random_nums=random_nums, 
-                 n_params=n_params, silent=True)(_input)
-        models.append(m)
+    models = MADE(in_shape, num_layers=num_layers, num_nodes=num_nodes, activation=activations, n_params=n_params, silent=True, 
+                  mixed_precision=mixed_precision, out_multiplier=n_models, order=order)(_input)
     
     return keras.Model(inputs=_input, outputs=models)
 
@@ -365,7 +508,8 @@ class MAConditionalFlowModel(MAFlowModel):
     Points in data-space can be sampled using model.sample(n_points, ...), see doc.
     """
     
-    def __init__(self, n_coupling, in_shape, param_hists, num_hidden_layers=1, num_nodes=128, permutations=None):
+    def __init__(self, n_coupling, in_shape, param_hists, num_hidden_layers=1, num_nodes=128, permutations=None, 
+                 mixed_precision=False, batch_size=None, jit_compile=False):
         """
         Parameters
         ----------
@@ -383,9 +527,18 @@ class MAConditionalFlowModel(MAFlowModel):
             number of nodes in the hidden layers of the used MADE layers (default 128)
         permutations: array-like
             permutations used in between coupling layers, either None (then they are generated by the model) or with shape (n_coupling-1, in_shape), default None
+        mixed_precision: boolean
+            whether the MADE layers compute in bfloat16, the flow itself and log_det stay in float32 (default False)
+        batch_size: int or None
+            if given, smaller training/validation batches are zero-padded to this size and the padding is masked in the loss, 
+            so the compiled model is not rebuilt for the last batch (should match the batch size used in fit, default None)
+        jit_compile: boolean
+            whether to XLA-compile the flow transformation, i.e. model(x), model.predict(z) and everything using them 
+            (needs a TensorFlow build with XLA support, default False)
         """
         
-        super().__init__(n_coupling, in_shape, num_hidden_layers, num_nodes, permutations)
+        super().__init__(n_coupling, in_shape, num_hidden_layers, num_nodes, permutations, mixed_precision, batch_size, 
+                         jit_compile)
         self.param_hists = []
         # Check histogram shape and calculate cumulative distributions
         for hist in param_hists:
@@ -400,39 +553,57 @@ class MAConditionalFlowModel(MAFlowModel):
         self.n_params = len(param_hists)
         if self.n_params == 0:
             raise Exception("If you don't want conditional parameters, just use MAFlowModel.")
+        # Stack cdfs and bin edges (padded with their last value to a common length) for vectorized sampling and densities
+        n_bins = max(len(hist[1]) for hist in self.param_hists)
+        self.cdfs = np.stack([np.pad(hist[0], (0, n_bins-len(hist[1])), mode="edge") for hist in self.param_hists])
+        self.edges = np.stack([np.pad(hist[1], (0, n_bins-len(hist[1])), mode="edge") for hist in self.param_hists])
+        # Rows offset by 2 each (cdfs lie in [0, 1]) concatenate to one sorted array, so one binary search covers all params
+        self._cdf_offsets = 2.0 * np.arange(self.n_params)
+        self._cdfs_flat = (self.cdfs.astype(np.float64) + self._cdf_offsets[:,None]).ravel()
+        self.cdf_stack = tf.constant(self.cdfs)
+        self.bin_edges_stack = tf.constant(self.edges)
+        # Same as in MAFlowModel, but offset by the conditional parameters
+        self._eye_mask_cond = tf.constant(np.stack([
+            np.concatenate([np.zeros((self.in_shape, self.n_params)), np.eye(self.in_shape)[q]], axis=1) for q in self.orders
+        ]).astype(np.float32))
+        # Extend total permutations once so they don't change params
+        param_range = tf.range(self.n_params, dtype=tf.int32)
+        self.flow_permutation = tf.concat([param_range, self.flow_permutation+self.n_params], axis=0)
+        self.inv_flow_permutation = tf.concat([param_range, self.inv_flow_permutation+self.n_params], axis=0)
         self.layers_list = [MAConditionalCoupling(in_shape, self.n_params, activations=["tanh", "linear"], 
-                                                  num_layers=num_hidden_layers, num_nodes=num_nodes) for i in range(n_coupling)]
-        self.left_zero_matrix = tf.concat([tf.zeros((self.in_shape, self.n_params)), tf.eye(self.in_shape)], axis=1)
+                                                  num_layers=num_hidden_layers, num_nodes=num_nodes, 
+                                                  mixed_precision=mixed_precision, order=np.argsort(q)+1) 
+                            for q in self.orders]
     
     def call(self, x, training=True):
         direction = 1 if training else -1
         log_det = 0
+        # Undo the total permutation of the latent space on the backward pass
+        if not training and self.n_coupling > 1:
+            x = tf.gather(x, self.inv_flow_permutation, axis=-1)
         # Loop over coupling layers forwards if direction is 1, else backwards
         for i in range(self.n_coupling)[::direction]:
             if training:
                 s, t = self.layers_list[i](x)
-                s = tf.matmul(s, self.left_zero_matrix)
-                t = tf.matmul(t, self.left_zero_matrix)
-                x = x * tf.exp(s) + t
-                log_det += tf.reduce_sum(s, axis=-1)
+                # Prepend zeros so the conditional parameters are left untouched
+                s = tf.pad(s, [[0,0],[self.n_params,0]])
+                t = tf.pad(t, [[0,0],[self.n_params,0]])
+                x, det = self._affine(x, s, t)
+                log_det += det
             else:
-                for k in range(self.in_shape):
+                # Invert one dimension per iteration; a while_loop keeps a single loop body in the graph
+                def body(k, x):
                     s, t = self.layers_list[i](x)
-                    s = tf.matmul(s, self.left_zero_matrix)
-                    t = tf.matmul(t, self.left_zero_matrix)
-                    mask = np.array([(1 if j == k+self.n_params else 0) for j in range(self.n_params+self.in_shape)])
-                    inv_mask = 1 - mask
-                    mask = tf.constant(mask, dtype=tf.float32)
-                    inv_mask = tf.constant(inv_mask, dtype=tf.float32)
-                    x = x * inv_mask + (tf.exp(-s) * (x - t)) * mask
-            # Permutations between coupling layers
-            if (training and i != self.n_coupling-1) or (not training and i != 0):
-                j = i if training else i-1
-                # Perm on forward pass and inverse perm on backward pass
-                perm = self.permutations[j] if training else np.argsort(self.permutations[j])
-                # Don't change params
-                perm = np.concatenate([np.arange(self.n_params), perm+self.n_params])
-                x = tf.gather(x, perm, axis=-1)
+                    # Prepend zeros so the conditional parameters are left untouched
+                    s = tf.pad(s, [[0,0],[self.n_params,0]])
+                    t = tf.pad(t, [[0,0],[self.n_params,0]])
+                    mask = self._eye_mask_cond[i,k]
+                    inv_mask = 1.0 - mask
+                    return k+1, x * inv_mask + (tf.exp(-s) * (x - t)) * mask
+                _, x = tf.while_loop(lambda k, x: k < self.in_shape, body, [tf.constant(0), x])
+        # Apply the total permutation on the forward pass
+        if training and self.n_coupling > 1:
+            x = tf.gather(x, self.flow_permutation, axis=-1)
         return x, log_det
     
     def sample(self, n_points, params=None, seed=None):
@@ -457,25 +628,22 @@ class MAConditionalFlowModel(MAFlowModel):
         return x
     
     def param_density(self, x):
-        params = x[:,:self.n_params]
-        densities = tf.ones_like(x[:,0])
-        for i in range(self.n_params):
-            m = params[:,i]
-            #Sort m vals into bins of histogram
-            m_ind = tf.searchsorted(self.param_hists[i][1], m) + 1
-            #Calculate densities from cdf
-            densities *= (tf.gather(self.param_hists[i][0], m_ind) - tf.gather(self.param_hists[i][0], tf.maximum(m_ind-1,0)))
-        return densities
+        params = tf.transpose(x[:,:self.n_params])
+        #Sort m vals into bins of histogram, one row per param
+        m_ind = tf.searchsorted(self.bin_edges_stack, params) + 1
+        #Calculate densities from cdf
+        upper = tf.gather(self.cdf_stack, m_ind, batch_dims=1)
+        lower = tf.gather(self.cdf_stack, tf.maximum(m_ind-1,0), batch_dims=1)
+        return tf.reduce_prod(upper - lower, axis=0)
     
     #Inverse transform sampling from histograms
     def ITS(self, n_points):
-        samples = [np.array([]).reshape(n_points,-1)]
-        for hist in self.param_hists:
-            vals = np.random.rand(n_points)
-            val_bins = np.searchsorted(hist[0], vals) - 1
-            points = hist[1][val_bins]
-            samples.append(points.reshape(-1,1))
-        return tf.constant(np.concatenate(samples, axis=1), dtype=tf.float32)
+        vals = np.random.rand(n_points, self.n_params)
+        # Equivalent to np.searchsorted(cdf, vals) - 1 for every parameter at once
+        row_len = self.cdfs.shape[1]
+        val_bins = np.searchsorted(self._cdfs_flat, vals + self._cdf_offsets) - row_len * np.arange(self.n_params) - 1
+        points = np.take_along_axis(self.edges, val_bins.T, axis=1).T
+        return tf.constant(points, dtype=tf.float32)
     
     def infer(self, x):
         """
@@ -487,13 +655,14 @@ class MAConditionalFlowModel(MAFlowModel):
             the data space sample whose density should be inferred
         """
         z, log_det = self(x)
-        log_density = self.distribution.log_prob(z[:,self.n_params:]) + log_det
+        log_density = self._latent_log_prob(z[:,self.n_params:]) + log_det
         return tf.exp(log_density)
     
-    def log_loss(self, x):
+    def log_loss(self, x, valid_mask=None):
         z, log_det = self(x)
-        log_likelihood = self.distribution.log_prob(z[:,self.n_params:]) + log_det
-        return (-tf.reduce_mean(log_likelihood), -tf.reduce_mean(self.distribution.log_prob(z[:,self.n_params:])), 
-                -tf.reduce_mean(log_det))
+        log_prob = self._latent_log_prob(z[:,self.n_params:])
+        log_likelihood = log_prob + log_det
+        return (-self._masked_mean(log_likelihood, valid_mask), -self._masked_mean(log_prob, valid_mask), 
+                -self._masked_mean(log_det, valid_mask))
 
 